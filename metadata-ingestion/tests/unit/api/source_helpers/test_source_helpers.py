@@ -1,7 +1,8 @@
+import functools
 import logging
 from datetime import datetime
-from typing import Any, Dict, Iterable, List, Union
-from unittest.mock import patch
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from unittest.mock import MagicMock
 
 import pytest
 from freezegun import freeze_time
@@ -60,8 +61,13 @@ _base_metadata: List[
 ]
 
 
-def test_auto_workunit():
-    wu = list(auto_workunit(_base_metadata))
+@pytest.fixture(scope="module")
+def base_wus() -> Tuple[MetadataWorkUnit, ...]:
+    return tuple(auto_workunit(_base_metadata))
+
+
+def test_auto_workunit(base_wus: Tuple[MetadataWorkUnit, ...]) -> None:
+    wu = base_wus
     assert all(isinstance(w, MetadataWorkUnit) for w in wu)
 
     ids = [w.id for w in wu]
@@ -73,80 +79,88 @@ def test_auto_workunit():
     ]
 
 
-def test_auto_status_aspect():
-    initial_wu = list(auto_workunit(_base_metadata))
+def test_auto_status_aspect(base_wus: Tuple[MetadataWorkUnit, ...]) -> None:
+    extra = tuple(
+        auto_workunit(
+            [
+                MetadataChangeProposalWrapper(
+                    entityUrn="urn:li:container:008e111aa1d250dd52e0fd5d4b307b1a",
+                    aspect=models.StatusClass(removed=False),
+                ),
+                MetadataChangeProposalWrapper(
+                    entityUrn="urn:li:dataset:(urn:li:dataPlatform:bigquery,bigquery-public-data.covid19_aha.staffing,PROD)",
+                    aspect=models.StatusClass(removed=False),
+                ),
+            ]
+        )
+    )
+    assert tuple(auto_status_aspect(base_wus)) == base_wus + extra
 
-    expected = [
-        *initial_wu,
-        *list(
-            auto_workunit(
-                [
-                    MetadataChangeProposalWrapper(
-                        entityUrn="urn:li:container:008e111aa1d250dd52e0fd5d4b307b1a",
-                        aspect=models.StatusClass(removed=False),
-                    ),
-                    MetadataChangeProposalWrapper(
-                        entityUrn="urn:li:dataset:(urn:li:dataPlatform:bigquery,bigquery-public-data.covid19_aha.staffing,PROD)",
-                        aspect=models.StatusClass(removed=False),
-                    ),
-                ]
-            )
-        ),
-    ]
-    assert list(auto_status_aspect(initial_wu)) == expected
+
+@functools.lru_cache(maxsize=None)
+def _urn(key: str) -> str:
+    return make_container_urn(key)
 
 
 def _create_container_aspects(
     d: Dict[str, Any],
-    other_aspects: Dict[str, List[models._Aspect]] = {},
-    root: bool = True,
+    other_aspects: Optional[Dict[str, List[models._Aspect]]] = None,
 ) -> Iterable[MetadataWorkUnit]:
-    for k, v in d.items():
-        urn = make_container_urn(k)
+    remaining = dict(other_aspects) if other_aspects else {}
+
+    # Depth-first, emitting each node's children before descending into them
+    stack: List[Iterator[Tuple[str, Any]]] = [iter(d.items())]
+    while stack:
+        try:
+            k, v = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+
+        urn = _urn(k)
         yield MetadataChangeProposalWrapper(
             entityUrn=urn, aspect=models.StatusClass(removed=False)
         ).as_workunit()
 
-        for aspect in other_aspects.pop(k, []):
+        for aspect in remaining.pop(k, []):
             yield MetadataChangeProposalWrapper(
                 entityUrn=urn, aspect=aspect
             ).as_workunit()
 
-        for child in list(v):
+        for child in v:
             yield MetadataChangeProposalWrapper(
-                entityUrn=make_container_urn(child),
+                entityUrn=_urn(child),
                 aspect=models.ContainerClass(container=urn),
             ).as_workunit()
         if isinstance(v, dict):
-            yield from _create_container_aspects(
-                v, other_aspects=other_aspects, root=False
-            )
+            stack.append(iter(v.items()))
 
-    if root:
-        for k, v in other_aspects.items():
-            for aspect in v:
-                yield MetadataChangeProposalWrapper(
-                    entityUrn=make_container_urn(k), aspect=aspect
-                ).as_workunit()
+    for k, v in remaining.items():
+        for aspect in v:
+            yield MetadataChangeProposalWrapper(
+                entityUrn=_urn(k), aspect=aspect
+            ).as_workunit()
 
 
 def _make_container_browse_path_entries(
     path: List[str],
 ) -> List[models.BrowsePathEntryClass]:
-    return [
-        models.BrowsePathEntryClass(id=make_container_urn(s), urn=make_container_urn(s))
-        for s in path
-    ]
+    return [models.BrowsePathEntryClass(id=_urn(s), urn=_urn(s)) for s in path]
 
 
 def _make_browse_path_entries(path: List[str]) -> List[models.BrowsePathEntryClass]:
     return [models.BrowsePathEntryClass(id=s, urn=None) for s in path]
 
 
+_MY_PATH = _make_browse_path_entries(["my", "path"])
+_CONTAINER_PREFIXES = {
+    k: _make_container_browse_path_entries(list(k)) for k in ["a", "ab", "abc", "abcd"]
+}
+
+
 def prepend_platform_instance(
     path: List[models.BrowsePathEntryClass],
 ) -> List[models.BrowsePathEntryClass]:
-
     platform = "platform"
     instance = "instance"
     return _prepend_platform_instance(path, platform, instance)
@@ -164,8 +178,23 @@ def _get_browse_paths_from_wu(
     return paths
 
 
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_by_container_hierarchy(telemetry_ping_mock):
+@pytest.fixture
+def telemetry_ping_mock(monkeypatch: pytest.MonkeyPatch) -> MagicMock:
+    ping_mock = MagicMock()
+    monkeypatch.setattr(
+        "datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping",
+        ping_mock,
+    )
+    return ping_mock
+
+
+@pytest.fixture(scope="module")
+def simple_container_wus() -> Tuple[MetadataWorkUnit, ...]:
+    return tuple(_create_container_aspects({"a": {"b": ["c"]}}))
+
+
+@pytest.fixture(scope="module")
+def deep_structure_wus() -> Tuple[MetadataWorkUnit, ...]:
     structure = {
         "one": {
             "a": {"i": ["1", "2", "3"], "ii": ["4"]},
@@ -177,8 +206,13 @@ def test_auto_browse_path_v2_by_container_hierarchy(telemetry_ping_mock):
         "three": {"d": {}},
         "four": {},
     }
+    return tuple(auto_status_aspect(_create_container_aspects(structure)))
+
 
-    wus = list(auto_status_aspect(_create_container_aspects(structure)))
+def test_auto_browse_path_v2_by_container_hierarchy(
+    telemetry_ping_mock: MagicMock, deep_structure_wus: Tuple[MetadataWorkUnit, ...]
+) -> None:
+    wus = deep_structure_wus
     assert (  # Sanity check
         sum(bool(wu.get_aspect_of_type(models.StatusClass)) for wu in wus) == 21
     )
@@ -201,129 +235,131 @@ def test_auto_browse_path_v2_by_container_hierarchy(telemetry_ping_mock):
     assert paths["i"] == _make_container_browse_path_entries(["one", "a"])
 
     # Check urns emitted on demand -- not all at end
-    for urn in {wu.get_urn() for wu in new_wus}:
-        try:
-            idx = next(
-                i
-                for i, wu in enumerate(new_wus)
-                if wu.get_aspect_of_type(models.ContainerClass) and wu.get_urn() == urn
-            )
-        except StopIteration:
-            idx = next(
-                i
-                for i, wu in enumerate(new_wus)
-                if wu.get_aspect_of_type(models.StatusClass) and wu.get_urn() == urn
-            )
+    container_idx: Dict[str, int] = {}
+    status_idx: Dict[str, int] = {}
+    for i, wu in enumerate(new_wus):
+        urn = wu.get_urn()
+        if urn not in container_idx and wu.get_aspect_of_type(models.ContainerClass):
+            container_idx[urn] = i
+        if urn not in status_idx and wu.get_aspect_of_type(models.StatusClass):
+            status_idx[urn] = i
+
+    # Every urn has a Status aspect, so this covers all urns in new_wus
+    all_urns: Set[str] = set(container_idx) | set(status_idx)
+    for urn in all_urns:
+        idx = container_idx[urn] if urn in container_idx else status_idx[urn]
         assert new_wus[idx + 1].get_aspect_of_type(
             models.BrowsePathsV2Class
         ) or new_wus[idx + 2].get_aspect_of_type(models.BrowsePathsV2Class)
 
 
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_ignores_urns_already_with(telemetry_ping_mock):
-    structure = {"a": {"b": {"c": {"d": ["e"]}}}}
-
-    wus = [
-        *auto_status_aspect(
-            _create_container_aspects(
-                structure,
-                other_aspects={
-                    "f": [
-                        models.BrowsePathsClass(paths=["/one/two"]),
-                        models.BrowsePathsV2Class(
-                            path=_make_browse_path_entries(["my", "path"])
-                        ),
-                    ],
-                    "c": [
-                        models.BrowsePathsV2Class(
-                            path=_make_container_browse_path_entries(["custom", "path"])
-                        )
-                    ],
-                },
-            ),
-        )
-    ]
-    new_wus = list(auto_browse_path_v2(wus))
-    assert not telemetry_ping_mock.call_count, telemetry_ping_mock.call_args_list
-    assert (
-        sum(bool(wu.get_aspect_of_type(models.BrowsePathsV2Class)) for wu in new_wus)
-        == 6
-    )
-
-    paths = _get_browse_paths_from_wu(new_wus)
-    assert paths["a"] == []
-    assert paths["c"] == _make_container_browse_path_entries(["custom", "path"])
-    assert paths["f"] == _make_browse_path_entries(["my", "path"])
-    assert paths["d"] == _make_container_browse_path_entries(["custom", "path", "c"])
-    assert paths["e"] == _make_container_browse_path_entries(
-        ["custom", "path", "c", "d"]
-    )
-
-
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_with_platform_instance_and_source_browse_path_v2(
-    telemetry_ping_mock,
-):
-    structure = {"a": {"b": {"c": {"d": ["e"]}}}}
+_MY_PLATFORM_INSTANCE_URN = make_dataplatform_instance_urn("my_platform", "my_instance")
+_MY_PLATFORM_INSTANCE_ENTRY = models.BrowsePathEntryClass(
+    _MY_PLATFORM_INSTANCE_URN, _MY_PLATFORM_INSTANCE_URN
+)
 
-    platform = "platform"
-    instance = "instance"
 
-    wus = [
-        *auto_status_aspect(
-            _create_container_aspects(
-                structure,
-                other_aspects={
-                    "a": [
-                        models.BrowsePathsV2Class(
-                            path=_make_browse_path_entries(["my", "path"]),
-                        ),
-                    ],
-                },
-            ),
+@pytest.mark.parametrize(
+    "structure,other_aspects,kwargs,expected",
+    [
+        pytest.param(
+            {"a": {"b": {"c": {"d": ["e"]}}}},
+            {
+                "f": [
+                    models.BrowsePathsClass(paths=["/one/two"]),
+                    models.BrowsePathsV2Class(
+                        path=_make_browse_path_entries(["my", "path"])
+                    ),
+                ],
+                "c": [
+                    models.BrowsePathsV2Class(
+                        path=_make_container_browse_path_entries(["custom", "path"])
+                    )
+                ],
+            },
+            {},
+            {
+                "a": [],
+                "b": _CONTAINER_PREFIXES["a"],
+                "c": _make_container_browse_path_entries(["custom", "path"]),
+                "d": _make_container_browse_path_entries(["custom", "path", "c"]),
+                "e": _make_container_browse_path_entries(["custom", "path", "c", "d"]),
+                "f": _MY_PATH,
+            },
+            id="ignores_urns_already_with",
+        ),
+        pytest.param(
+            {"a": {"b": {"c": {"d": ["e"]}}}},
+            {
+                "a": [
+                    models.BrowsePathsV2Class(
+                        path=_make_browse_path_entries(["my", "path"])
+                    )
+                ]
+            },
+            {"platform": "platform", "platform_instance": "instance"},
+            {
+                "a": prepend_platform_instance(_MY_PATH),
+                "b": prepend_platform_instance([*_MY_PATH, *_CONTAINER_PREFIXES["a"]]),
+                "c": prepend_platform_instance([*_MY_PATH, *_CONTAINER_PREFIXES["ab"]]),
+                "d": prepend_platform_instance(
+                    [*_MY_PATH, *_CONTAINER_PREFIXES["abc"]]
+                ),
+                "e": prepend_platform_instance(
+                    [*_MY_PATH, *_CONTAINER_PREFIXES["abcd"]]
+                ),
+            },
+            id="with_platform_instance_and_source_browse_path_v2",
+        ),
+        pytest.param(
+            {"a": {"b": ["c"]}},
+            {"b": [models.BrowsePathsClass(paths=["/one/two"])]},
+            {},
+            {
+                "a": [],
+                "b": _CONTAINER_PREFIXES["a"],
+                "c": _CONTAINER_PREFIXES["ab"],
+            },
+            id="container_over_legacy_browse_path",
+        ),
+        pytest.param(
+            {"a": {"b": ["c"]}},
+            {},
+            {"platform": "my_platform", "platform_instance": "my_instance"},
+            {
+                "a": [_MY_PLATFORM_INSTANCE_ENTRY],
+                "b": [_MY_PLATFORM_INSTANCE_ENTRY, *_CONTAINER_PREFIXES["a"]],
+                "c": [_MY_PLATFORM_INSTANCE_ENTRY, *_CONTAINER_PREFIXES["ab"]],
+            },
+            id="with_platform_instance",
+        ),
+    ],
+)
+def test_auto_browse_path_v2(
+    telemetry_ping_mock: MagicMock,
+    structure: Dict[str, Any],
+    other_aspects: Dict[str, List[models._Aspect]],
+    kwargs: Dict[str, Any],
+    expected: Dict[str, List[models.BrowsePathEntryClass]],
+) -> None:
+    wus = list(
+        auto_status_aspect(
+            _create_container_aspects(structure, other_aspects=other_aspects)
         )
-    ]
-    new_wus = list(
-        auto_browse_path_v2(wus, platform=platform, platform_instance=instance)
     )
+    new_wus = list(auto_browse_path_v2(wus, **kwargs))
     assert not telemetry_ping_mock.call_count, telemetry_ping_mock.call_args_list
-    assert (
-        sum(bool(wu.get_aspect_of_type(models.BrowsePathsV2Class)) for wu in new_wus)
-        == 5
-    )
+    assert sum(
+        bool(wu.get_aspect_of_type(models.BrowsePathsV2Class)) for wu in new_wus
+    ) == len(expected)
 
     paths = _get_browse_paths_from_wu(new_wus)
-    assert paths["a"] == prepend_platform_instance(
-        _make_browse_path_entries(["my", "path"]),
-    )
-    assert paths["b"] == prepend_platform_instance(
-        [
-            *_make_browse_path_entries(["my", "path"]),
-            *_make_container_browse_path_entries(["a"]),
-        ],
-    )
-    assert paths["c"] == prepend_platform_instance(
-        [
-            *_make_browse_path_entries(["my", "path"]),
-            *_make_container_browse_path_entries(["a", "b"]),
-        ],
-    )
-    assert paths["d"] == prepend_platform_instance(
-        [
-            *_make_browse_path_entries(["my", "path"]),
-            *_make_container_browse_path_entries(["a", "b", "c"]),
-        ],
-    )
-    assert paths["e"] == prepend_platform_instance(
-        [
-            *_make_browse_path_entries(["my", "path"]),
-            *_make_container_browse_path_entries(["a", "b", "c", "d"]),
-        ],
-    )
+    assert paths == expected
 
 
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_legacy_browse_path(telemetry_ping_mock):
+def test_auto_browse_path_v2_legacy_browse_path(
+    telemetry_ping_mock: MagicMock,
+) -> None:
     platform = "platform"
     env = "PROD"
     wus = [
@@ -421,73 +457,12 @@ def test_auto_lowercase_aspects():
     assert list(auto_lowercase_urns(mcws)) == expected
 
 
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_container_over_legacy_browse_path(telemetry_ping_mock):
-    structure = {"a": {"b": ["c"]}}
-    wus = list(
-        auto_status_aspect(
-            _create_container_aspects(
-                structure,
-                other_aspects={"b": [models.BrowsePathsClass(paths=["/one/two"])]},
-            ),
-        )
-    )
-    new_wus = list(auto_browse_path_v2(wus))
-    assert not telemetry_ping_mock.call_count, telemetry_ping_mock.call_args_list
-    assert (
-        sum(bool(wu.get_aspect_of_type(models.BrowsePathsV2Class)) for wu in new_wus)
-        == 3
-    )
-
-    paths = _get_browse_paths_from_wu(new_wus)
-    assert paths["a"] == []
-    assert paths["b"] == _make_container_browse_path_entries(["a"])
-    assert paths["c"] == _make_container_browse_path_entries(["a", "b"])
-
-
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_with_platform_instance(telemetry_ping_mock):
-    platform = "my_platform"
-    platform_instance = "my_instance"
-    platform_instance_urn = make_dataplatform_instance_urn(platform, platform_instance)
-    platform_instance_entry = models.BrowsePathEntryClass(
-        platform_instance_urn, platform_instance_urn
-    )
-
-    structure = {"a": {"b": ["c"]}}
-    wus = list(auto_status_aspect(_create_container_aspects(structure)))
-
-    new_wus = list(
-        auto_browse_path_v2(
-            wus,
-            platform=platform,
-            platform_instance=platform_instance,
-        )
-    )
-    assert telemetry_ping_mock.call_count == 0
-
-    assert (
-        sum(bool(wu.get_aspect_of_type(models.BrowsePathsV2Class)) for wu in new_wus)
-        == 3
-    )
-    paths = _get_browse_paths_from_wu(new_wus)
-    assert paths["a"] == [platform_instance_entry]
-    assert paths["b"] == [
-        platform_instance_entry,
-        *_make_container_browse_path_entries(["a"]),
-    ]
-    assert paths["c"] == [
-        platform_instance_entry,
-        *_make_container_browse_path_entries(["a", "b"]),
-    ]
-
-
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_invalid_batch_telemetry(telemetry_ping_mock):
-    structure = {"a": {"b": ["c"]}}
+def test_auto_browse_path_v2_invalid_batch_telemetry(
+    telemetry_ping_mock: MagicMock, simple_container_wus: Tuple[MetadataWorkUnit, ...]
+) -> None:
     b_urn = make_container_urn("b")
     wus = [
-        *_create_container_aspects(structure),
+        *simple_container_wus,
         MetadataChangeProposalWrapper(  # Browse path for b separate from its Container aspect
             entityUrn=b_urn,
             aspect=models.BrowsePathsClass(paths=["/one/two"]),
@@ -503,14 +478,12 @@ def test_auto_browse_path_v2_invalid_batch_telemetry(telemetry_ping_mock):
     assert telemetry_ping_mock.call_args_list[0][0][1]["num_out_of_batch"] == 1
 
 
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
 def test_auto_browse_path_v2_no_invalid_batch_telemetry_for_unrelated_aspects(
-    telemetry_ping_mock,
-):
-    structure = {"a": {"b": ["c"]}}
+    telemetry_ping_mock: MagicMock, simple_container_wus: Tuple[MetadataWorkUnit, ...]
+) -> None:
     b_urn = make_container_urn("b")
     wus = [
-        *_create_container_aspects(structure),
+        *simple_container_wus,
         MetadataChangeProposalWrapper(  # Browse path for b separate from its Container aspect
             entityUrn=b_urn,
             aspect=models.ContainerPropertiesClass("container name"),
@@ -523,10 +496,10 @@ def test_auto_browse_path_v2_no_invalid_batch_telemetry_for_unrelated_aspects(
     assert telemetry_ping_mock.call_count == 0
 
 
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_invalid_order_telemetry(telemetry_ping_mock):
-    structure = {"a": {"b": ["c"]}}
-    wus = list(reversed(list(_create_container_aspects(structure))))
+def test_auto_browse_path_v2_invalid_order_telemetry(
+    telemetry_ping_mock: MagicMock, simple_container_wus: Tuple[MetadataWorkUnit, ...]
+) -> None:
+    wus = list(reversed(simple_container_wus))
     wus = list(auto_status_aspect(wus))
 
     assert telemetry_ping_mock.call_count == 0
@@ -541,10 +514,10 @@ def test_auto_browse_path_v2_invalid_order_telemetry(telemetry_ping_mock):
     assert telemetry_ping_mock.call_args_list[0][0][1]["num_out_of_batch"] == 0
 
 
-@patch("datahub.ingestion.api.source_helpers.telemetry.telemetry_instance.ping")
-def test_auto_browse_path_v2_dry_run(telemetry_ping_mock):
-    structure = {"a": {"b": ["c"]}}
-    wus = list(reversed(list(_create_container_aspects(structure))))
+def test_auto_browse_path_v2_dry_run(
+    telemetry_ping_mock: MagicMock, simple_container_wus: Tuple[MetadataWorkUnit, ...]
+) -> None:
+    wus = list(reversed(simple_container_wus))
     wus = list(auto_status_aspect(wus))
 
     assert telemetry_ping_mock.call_count == 0